@@ -1,18 +1,23 @@
 import os
-import pytesseract
-from pdf2image import convert_from_path
+
+# Tesseract's OpenMP threads fight with our one-process-per-core pool; the Tesseract
+# benchmarks show a single thread per process is fastest. Must be set before tesserocr loads.
+os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+from tesserocr import PyTessBaseAPI, PSM, OEM
+from pdf2image import convert_from_path, pdfinfo_from_path
 import pandas as pd
 import re
 import sys
 import logging
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
-from functools import partial
 import PyPDF2
+import pikepdf
 import csv
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
-import tempfile
-import time
+from PIL import Image
+import numpy as np
+import cv2
 import traceback
 
 # ==================== Environment Setup ====================
@@ -20,8 +25,17 @@ import traceback
 # Add Poppler's bin directory to PATH before any imports that might use it
 os.environ['PATH'] += os.pathsep + r'C:\Users\thomsz\AppData\Local\Programs\Poppler\bin'
 
-# Path to Tesseract OCR executable
-pytesseract.pytesseract.tesseract_cmd = r'C:\Users\thomsz\AppData\Local\Programs\Tesseract-OCR\tesseract.exe'
+# Path to Tesseract's tessdata directory (language models used by tesserocr)
+tessdata_path = r'C:\Users\thomsz\AppData\Local\Programs\Tesseract-OCR\tessdata'
+
+# Per-process Tesseract API instance, created once by init_worker()
+ocr_api = None
+
+# OSD orientation confidence above which the 180 degree OCR fallback is skipped
+osd_confidence_threshold = 2.0
+
+# Log the full OCR text alongside each match (large log lines; only useful when debugging patterns)
+log_ocr_text = False
 
 # ==================== Logging Configuration ====================
 
@@ -34,17 +48,17 @@ logging.basicConfig(
 
 # ==================== Regex Patterns ====================
 
-# Define Route ID Pattern
-route_id_pattern = re.compile(r'\bRoute[:\s]*:?(\d{8})\b', re.IGNORECASE)
-
-# Define Store Name Patterns
-to_pattern = re.compile(
-    r'\bTo\s+\d+\s+(\d{4})-([A-Za-z0-9\s\(\)]+)', re.IGNORECASE
+# Define Route ID and Store Name Patterns as one alternation so the text is scanned once.
+# Each branch sits in a lookahead so a greedy store name can't swallow a following Route.
+combined_pattern = re.compile(
+    r'(?=(?P<route>\bRoute[:\s]*:?(?P<route_id>\d{8})\b))'
+    r'|(?=(?P<xdock>\bX-Dock WH\s*:\s*(?P<xdock_location>\d{4})-(?P<xdock_store>[A-Za-z0-9\s]+)))'
+    r'|(?=(?P<to>\bTo\s+\d+\s+(?P<to_location>\d{4})-(?P<to_store>[A-Za-z0-9\s\(\)]+)))',
+    re.IGNORECASE | re.ASCII  # The keywords are ASCII; skip Unicode case folding
 )
 
-xdock_wh_pattern = re.compile(
-    r'\bX-Dock WH\s*:\s*(\d{4})-([A-Za-z0-9\s]+)', re.IGNORECASE
-)
+# Trailing "Phone ..." text to cut off store names
+phone_pattern = re.compile(r'\sPhone', re.ASCII)
 
 # ==================== Directory Setup ====================
 
@@ -56,124 +70,127 @@ os.makedirs(matched_pages_dir, exist_ok=True)
 
 # ==================== Utility Functions ====================
 
-def clean_temp_files(prefix="tess_"):
-    temp_dir = tempfile.gettempdir()
-    for filename in os.listdir(temp_dir):
-        if filename.startswith(prefix):
-            file_path = os.path.join(temp_dir, filename)
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logging.warning(f"Failed to remove temporary file {file_path}: {e}")
-
-def robust_image_to_osd(image, config, retries=3, delay=1):
-    for attempt in range(retries):
-        try:
-            return pytesseract.image_to_osd(image, config=config)
-        except Exception as e:
-            logging.warning(f"OSD attempt {attempt + 1} failed: {e}")
-            time.sleep(delay)
-    raise e  # Raise the exception after all retries fail
+def init_worker():
+    # Load the Tesseract model once per process and reuse it for every page.
+    # AUTO_OSD detects orientation during layout analysis, so no separate OSD pass is needed.
+    # Never raise here: a failing Pool initializer makes the pool respawn workers forever.
+    global ocr_api
+    try:
+        ocr_api = PyTessBaseAPI(path=tessdata_path, lang='eng', psm=PSM.AUTO_OSD, oem=OEM.DEFAULT)
+    except Exception as e:
+        logging.error(f"Failed to initialize Tesseract from {tessdata_path}: {e}")
+        ocr_api = None
+
+def ocr_image(image):
+    if ocr_api is None:
+        raise RuntimeError(f"Tesseract is not available (check tessdata_path: {tessdata_path})")
+    ocr_api.SetImage(image)
+    return ocr_api.GetUTF8Text()
+
+def orientation_is_confident():
+    # Runs OSD on the image last passed to ocr_image(); no extra OCR pass
+    try:
+        osd = ocr_api.DetectOrientationScript()
+    except Exception as e:
+        logging.warning(f"Orientation detection failed: {e}")
+        return False
+    return bool(osd) and osd['orient_conf'] > osd_confidence_threshold
 
 # ==================== Image Preprocessing ====================
 
 def preprocess_image(image):
-    # Convert to grayscale
-    image = image.convert('L')
+    # Pages are rendered in grayscale already; the rest runs as vectorized OpenCV ops
+    arr = np.asarray(image)
 
-    # Enhance contrast
-    enhancer = ImageEnhance.Contrast(image)
-    image = enhancer.enhance(2)
+    # Smooth out scan noise before binarization
+    arr = cv2.GaussianBlur(arr, (5, 5), 0)
 
-    # Apply sharpening filter
-    image = image.filter(ImageFilter.SHARPEN)
+    # Otsu thresholding picks the cutoff per page instead of a fixed 128
+    _, binary = cv2.threshold(arr, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
 
-    # Adaptive thresholding using PIL's point function
-    image = image.point(lambda x: 0 if x < 128 else 255, '1')
-
-    return image
+    # Tesseract API and the rotation fallback both work on PIL images
+    return Image.fromarray(binary)
 
 # ==================== OCR and Data Extraction ====================
 
-def extract_info_from_page(page_image, pdf_path, page_number):
-    try:
-        # Clean temporary files to prevent clutter
-        clean_temp_files()
+def _match_text(text):
+    # Every match needs a Route ID, so skip the regex scan on pages without the keyword
+    if 'route' not in text.lower():
+        return []
 
-        # Configuration for OSD
-        osd_config = r'--oem 3 --psm 0 -l osd'
+    route_matches = []
+    to_matches = []
+    xdock_wh_matches = []
 
-        # Attempt to detect orientation using OSD with retries
-        try:
-            osd = robust_image_to_osd(page_image, config=osd_config)
-            rotation = int(re.search(r'Rotate: (\d+)', osd).group(1))
-            logging.debug(f"OSD for {pdf_path} page {page_number}: Rotate={rotation} degrees.")
+    for m in combined_pattern.finditer(text):
+        if m.lastgroup == 'route':
+            route_matches.append(m.group('route_id'))
+        elif m.lastgroup == 'xdock':
+            xdock_wh_matches.append((m.group('xdock_location'), m.group('xdock_store')))
+        elif m.lastgroup == 'to':
+            to_matches.append((m.group('to_location'), m.group('to_store')))
 
-            if rotation != 0:
-                # Correct the image rotation
-                corrected_image = page_image.rotate(-rotation, expand=True)
-                logging.info(f"Rotated page {page_number} of {pdf_path} by {-rotation} degrees to correct orientation.")
-            else:
-                corrected_image = page_image
+    matches = []
 
-        except Exception as e:
-            logging.warning(f"Orientation detection failed for {pdf_path} page {page_number}: {e}")
-            corrected_image = page_image  # Proceed without rotation
+    for route_id in route_matches:
+        location_number = None
+        store_name = None
+        source = None
+
+        # Prioritize X-Dock WH matches over To matches
+        if xdock_wh_matches:
+            location_number, store_name = xdock_wh_matches[0]
+            source = "X-Dock WH"
+        elif to_matches:
+            location_number, store_name = to_matches[0]
+            source = "To"
 
-        # Configuration for OCR
-        ocr_config = r'--oem 3 --psm 6 -l eng'
+        if location_number and store_name:
+            # Clean StoreName by removing trailing unwanted text
+            phone_match = phone_pattern.search(store_name)
+            if phone_match:
+                store_name = store_name[:phone_match.start()]
+            store_name = store_name.strip()
 
-        # Perform OCR on the (possibly rotated) image
-        text = pytesseract.image_to_string(corrected_image, config=ocr_config)
-        route_matches = route_id_pattern.findall(text)
-        to_matches = to_pattern.findall(text)
-        xdock_wh_matches = xdock_wh_pattern.findall(text)
+            matches.append((route_id, location_number, store_name, source))
 
-        matches = []
+    return matches
 
-        if not route_matches:
+def extract_info_from_page(page_image, pdf_path, page_number):
+    try:
+        rotation = 0
+
+        # Perform OCR; orientation is detected and corrected by Tesseract itself
+        text = ocr_image(page_image)
+        matches = _match_text(text)
+
+        if not matches and orientation_is_confident():
+            # Tesseract already handled orientation; an upside-down retry would just repeat the OCR
+            logging.info(f"Skipping 180 degree fallback on page {page_number} of {pdf_path}: orientation detected with high confidence.")
+        elif not matches:
             # Fallback: Rotate by 180 degrees and try OCR again
-            rotated_image = corrected_image.rotate(180, expand=True)
+            rotated_image = page_image.rotate(180, expand=True)
             logging.info(f"Rotated page {page_number} of {pdf_path} by 180 degrees as fallback.")
-            text_rotated = pytesseract.image_to_string(rotated_image, config=ocr_config)
-            route_matches = route_id_pattern.findall(text_rotated)
-            to_matches = to_pattern.findall(text_rotated)
-            xdock_wh_matches = xdock_wh_pattern.findall(text_rotated)
+            text_rotated = ocr_image(rotated_image)
+            matches = _match_text(text_rotated)
 
-            if route_matches:
+            if matches:
                 logging.info(f"Found RouteID after rotating 180 degrees on page {page_number} of {pdf_path}.")
                 text = text_rotated  # Use rotated text for logging and extraction
+                rotation = 180
 
-        for route_id in route_matches:
-            location_number = None
-            store_name = None
-            source = None
-
-            # Prioritize X-Dock WH matches over To matches
-            if xdock_wh_matches:
-                location_number, store_name = xdock_wh_matches[0]
-                source = "X-Dock WH"
-            elif to_matches:
-                location_number, store_name = to_matches[0]
-                source = "To"
-
-            if location_number and store_name:
-                # Clean StoreName by removing trailing unwanted text
-                store_name = re.split(r'\sPhone', store_name)[0].strip()
-
-                matches.append((route_id, location_number, store_name))
-
-                # Debugging: Print extracted text and matches if RouteID is found
+        # Debugging: Log the full OCR text with each match when log_ocr_text is switched on
+        if log_ocr_text and logging.getLogger().isEnabledFor(logging.DEBUG):
+            for route_id, location_number, store_name, source in matches:
                 debug_message = (
                     f"\n[DEBUG] PDF: {os.path.basename(pdf_path)} - Page: {page_number}\n"
-                    f"Rotation Applied: {'-{}'.format(rotation) if 'rotation' in locals() and rotation !=0 else '0'} degrees\n"
+                    f"Fallback Rotation Applied: {rotation} degrees\n"
                     f"OCR Text:\n{text}\n"
                     f"Extracted RouteID: {route_id}\n"
                     f"Extracted Location Number: {location_number}\n"
                     f"Extracted Store Name: {store_name}\n"
                     f"Source Pattern: {source}\n"
                 )
-                print(debug_message)  # Print to console for immediate feedback
                 logging.debug(debug_message)  # Log to file for later analysis
 
         if not matches:
@@ -187,65 +204,96 @@ def extract_info_from_page(page_image, pdf_path, page_number):
 
 # ==================== PDF Processing ====================
 
-def extract_and_save_page(pdf_path, page_number, route_id, location_number):
+def extract_and_save_page(src, pdf_path, page_number, route_id, location_number):
     try:
-        # Open the original PDF
-        with open(pdf_path, 'rb') as infile:
-            reader = PyPDF2.PdfReader(infile)
-            writer = PyPDF2.PdfWriter()
-
-            # PyPDF2 uses zero-based indexing for pages
-            writer.add_page(reader.pages[page_number - 1])
-
-            # Define the new PDF's filename
-            new_pdf_name = f"{route_id} - {location_number}.pdf"
+        # Define the new PDF's filename
+        new_pdf_name = f"{route_id} - {location_number}.pdf"
+        new_pdf_path = os.path.join(matched_pages_dir, new_pdf_name)
+
+        # Handle naming conflicts by appending a count if the file already exists
+        count = 1
+        while os.path.exists(new_pdf_path):
+            new_pdf_name = f"{route_id} - {location_number} ({count}).pdf"
             new_pdf_path = os.path.join(matched_pages_dir, new_pdf_name)
+            count += 1
 
-            # Handle naming conflicts by appending a count if the file already exists
-            count = 1
-            while os.path.exists(new_pdf_path):
-                new_pdf_name = f"{route_id} - {location_number} ({count}).pdf"
-                new_pdf_path = os.path.join(matched_pages_dir, new_pdf_name)
-                count += 1
-
-            # Write the new PDF
-            with open(new_pdf_path, 'wb') as outfile:
-                writer.write(outfile)
+        # Copy the page structurally into a new PDF without re-encoding its content streams
+        with pikepdf.Pdf.new() as dst:
+            # pikepdf uses zero-based indexing for pages
+            dst.pages.append(src.pages[page_number - 1])
+            dst.save(new_pdf_path)
 
-            logging.info(f"Saved extracted page to {new_pdf_path}")
-            print(f"Saved: {new_pdf_path}")  # Inform the user
+        logging.info(f"Saved extracted page to {new_pdf_path}")
+        print(f"Saved: {new_pdf_path}")  # Inform the user
     except Exception as e:
         logging.error(f"Failed to extract/save page {page_number} from {pdf_path}: {traceback.format_exc()}")
         print(f"Error saving page {page_number} from {os.path.basename(pdf_path)}.")
 
-def extract_route_and_store_ids(pdf_path):
+# Column order of the result tuples produced by build_results()
+result_columns = ['RouteID', 'LocationNumber', 'StoreName', 'PDF', 'PageNumber']
+
+def build_results(matches, pdf_path, page_number):
     results = []
+    pdf_name = os.path.basename(pdf_path)
+    for route_id, location_number, store_name, source in matches:
+        results.append((route_id.upper(), location_number, store_name, pdf_name, page_number))
+        logging.info(f"Found RouteID {route_id}, Location {location_number}, Store '{store_name}' on page {page_number} of {pdf_path}")
+    return results
+
+def extract_text_layer(pdf_path):
+    # Fast path: read the embedded text layer and return the pages that still need OCR
+    results = []
+    ocr_tasks = []
     try:
-        # Convert PDF to images with sufficient DPI for OCR
-        pages = convert_from_path(pdf_path, dpi=200)  # Adjust DPI as needed
-        logging.info(f"Converted {pdf_path} to images. Number of pages: {len(pages)}")
-        print(f"Converted {pdf_path} to images. Number of pages: {len(pages)}")
+        with open(pdf_path, 'rb') as infile:
+            reader = PyPDF2.PdfReader(infile)
+            for page_number, page in enumerate(reader.pages, start=1):
+                try:
+                    text = page.extract_text() or ''
+                except Exception as e:
+                    logging.warning(f"Text layer extraction failed for {pdf_path} page {page_number}: {e}")
+                    text = ''
+
+                matches = _match_text(text)
+                if matches:
+                    results.extend(build_results(matches, pdf_path, page_number))
+                else:
+                    ocr_tasks.append((pdf_path, page_number))
 
-        for page_number, page in enumerate(pages, start=1):
+        logging.info(f"Read text layer of {pdf_path}. Pages needing OCR: {len(ocr_tasks)} of {len(reader.pages)}")
+    except Exception as e:
+        logging.warning(f"Could not read text layer of {pdf_path}, falling back to OCR for every page: {e}")
+        results = []
+        try:
+            # Poppler may still render PDFs that PyPDF2 can't parse
+            num_pages = pdfinfo_from_path(pdf_path)['Pages']
+            ocr_tasks = [(pdf_path, page_number) for page_number in range(1, num_pages + 1)]
+        except Exception as e:
+            logging.error(f"Error processing {pdf_path}: {traceback.format_exc()}")
+            print(f"Error processing {pdf_path}: {e}")
+            ocr_tasks = []
+
+    return results, ocr_tasks
+
+def process_single_page(task):
+    pdf_path, page_number = task
+    try:
+        # Convert only this page to a grayscale image; 150 DPI is enough for OCR on these documents
+        # and release the pixel buffers as soon as it's done so worker memory stays flat
+        page = convert_from_path(pdf_path, dpi=150, grayscale=True, first_page=page_number, last_page=page_number)[0]
+        try:
             preprocessed_page = preprocess_image(page)
+        finally:
+            page.close()
+        try:
             matches = extract_info_from_page(preprocessed_page, pdf_path, page_number)
-
-            for match in matches:
-                route_id, location_number, store_name = match
-                result = {
-                    'RouteID': route_id.upper(),
-                    'LocationNumber': location_number,
-                    'StoreName': store_name,
-                    'PDF': os.path.basename(pdf_path),
-                    'PageNumber': page_number
-                }
-                results.append(result)
-                logging.info(f"Found RouteID {route_id} on page {page_number} of {pdf_path}")
+        finally:
+            preprocessed_page.close()
+        return build_results(matches, pdf_path, page_number)
     except Exception as e:
-        logging.error(f"Error processing {pdf_path}: {traceback.format_exc()}")
-        print(f"Error processing {pdf_path}: {e}")
-
-    return results
+        logging.error(f"Error processing {pdf_path} page {page_number}: {traceback.format_exc()}")
+        print(f"Error processing {pdf_path} page {page_number}: {e}")
+        return []
 
 def process_pdfs(pdf_directory):
     pdf_files = [os.path.join(root, file)
@@ -253,23 +301,48 @@ def process_pdfs(pdf_directory):
                 for file in files if file.lower().endswith('.pdf')]
 
     all_results = []
-    pool_size = min(cpu_count() - 1, 4)  # Limit to 4 processes or adjust as needed
+    seen = set()  # (RouteID, LocationNumber, PDF, PageNumber) keys already collected
+    ocr_tasks = []
+    pool_size = max(1, cpu_count() - 1)  # One single-threaded process per core, leaving one for the system
 
     # Debug: Log the number of PDFs to process
     logging.info(f"Starting multiprocessing pool with {pool_size} processes for {len(pdf_files)} PDFs.")
     print(f"Starting multiprocessing pool with {pool_size} processes for {len(pdf_files)} PDFs.")
 
+    def add_results(results):
+        # Drop duplicates as they arrive instead of holding them until the end
+        for row in results:
+            route_id, location_number, store_name, pdf_name, page_number = row
+            key = (route_id, location_number, pdf_name, page_number)
+            if key in seen:
+                continue
+            seen.add(key)
+            all_results.append(row)
+
+    # First pass: read text layers and collect the (pdf, page) pairs that need OCR.
+    # This pool doesn't load Tesseract, so digital PDFs never depend on it.
     with Pool(processes=pool_size) as pool:
-        func = partial(extract_route_and_store_ids)
-        for result in tqdm(pool.imap_unordered(func, pdf_files), total=len(pdf_files), desc="Processing PDFs"):
-            all_results.extend(result)
+        # Batch tasks (about 4 chunks per worker) to cut per-task IPC without losing load balance
+        chunksize = max(1, len(pdf_files) // (pool_size * 4))
+        for results, tasks in tqdm(pool.imap_unordered(extract_text_layer, pdf_files, chunksize=chunksize), total=len(pdf_files), desc="Reading text layers"):
+            add_results(results)
+            ocr_tasks.extend(tasks)
+
+    # Second pass: OCR page by page so large PDFs are spread across all workers
+    logging.info(f"{len(ocr_tasks)} pages need OCR.")
+    if ocr_tasks:
+        with Pool(processes=pool_size, initializer=init_worker) as pool:
+            chunksize = max(1, len(ocr_tasks) // (pool_size * 4))
+            for result in tqdm(pool.imap_unordered(process_single_page, ocr_tasks, chunksize=chunksize), total=len(ocr_tasks), desc="OCR pages"):
+                add_results(result)
 
     if all_results:
-        results_df = pd.DataFrame(all_results)
-        results_df.drop_duplicates(subset=['RouteID', 'LocationNumber', 'PDF', 'PageNumber'], inplace=True)
+        results_df = pd.DataFrame.from_records(all_results, columns=result_columns)
+        # Pages finish out of order; group the rows back by PDF
+        results_df.sort_values(['PDF', 'PageNumber'], inplace=True)
         logging.info(f"Total Route IDs extracted: {len(results_df)}")
     else:
-        results_df = pd.DataFrame(columns=['RouteID', 'LocationNumber', 'StoreName', 'PDF', 'PageNumber'])
+        results_df = pd.DataFrame(columns=result_columns)
         logging.info("No Route IDs were extracted.")
 
     return results_df
@@ -278,7 +351,9 @@ def process_pdfs(pdf_directory):
 
 def save_results(df, output_path):
     try:
-        df.to_excel(output_path, index=False)
+        # xlsxwriter writes noticeably faster than openpyxl. Its constant_memory mode can't be
+        # used here: pandas writes cells column by column, which that mode would silently drop.
+        df.to_excel(output_path, index=False, engine='xlsxwriter')
         logging.info(f"Results saved to {output_path}")
     except Exception as e:
         logging.error(f"Error saving results to {output_path}: {traceback.format_exc()}")
@@ -287,6 +362,9 @@ def save_results(df, output_path):
 # ==================== Query Handling ====================
 
 def search_and_save(df, queries, pdf_directory):
+    # Matched pages grouped by PDF so each PDF is parsed only once
+    pages_to_save = {}
+
     for route_id, location_number in queries:
         matching_records = df[
             (df['RouteID'] == route_id.upper()) &
@@ -298,17 +376,27 @@ def search_and_save(df, queries, pdf_directory):
             for _, row in matching_records.iterrows():
                 print(f"- PDF: {row['PDF']}, Page: {row['PageNumber']}, Store: {row['StoreName']}")
 
-                # Extract and save the specific page as a new PDF
+                # Queue the specific page to be saved as a new PDF
                 pdf_path = os.path.join(pdf_directory, row['PDF'])  # Adjust if your PDFs are in a different directory
                 page_number = row['PageNumber']
                 if isinstance(page_number, int):
-                    extract_and_save_page(pdf_path, page_number, route_id, location_number)
+                    pages_to_save.setdefault(pdf_path, []).append((page_number, route_id, location_number))
                 else:
                     print(f"Warning: Page number is not available for PDF {row['PDF']}. Cannot save specific page.")
         else:
             print(f"\nRouteID '{route_id}' with Location Number '{location_number}' not found in any PDF.")
             logging.info(f"RouteID '{route_id}' with Location Number '{location_number}' not found.")
 
+    # Open each PDF once and extract all of its matched pages
+    for pdf_path, pages in pages_to_save.items():
+        try:
+            with pikepdf.open(pdf_path) as src:
+                for page_number, route_id, location_number in pages:
+                    extract_and_save_page(src, pdf_path, page_number, route_id, location_number)
+        except Exception as e:
+            logging.error(f"Failed to open {pdf_path}: {traceback.format_exc()}")
+            print(f"Error opening {os.path.basename(pdf_path)}.")
+
 def read_queries_from_csv(csv_path):
     queries = []
     try:
@@ -15,6 +15,9 @@ route_id_pattern = re.compile(r'\bRoute[:\s]*:?(\d{8})\b', re.IGNORECASE)
 to_pattern = re.compile(r'\bTo\s+\d+\s+(\d{4})-([A-Za-z0-9\s\(\)]+)', re.IGNORECASE)
 xdock_wh_pattern = re.compile(r'\bX-Dock WH\s*:\s*(\d{4})-([A-Za-z0-9\s]+)', re.IGNORECASE)
 
+# Precomputed threshold lookup table (0 below 140, 255 from 140 up)
+_THRESH_LUT = [0] * 140 + [255] * 116
+
 def preprocess_image(image):
     """
     Preprocess the image to enhance OCR accuracy.
@@ -29,7 +32,7 @@ def preprocess_image(image):
     enhancer = ImageEnhance.Contrast(image)
     image = enhancer.enhance(2)  # Adjust contrast as needed
     image = ImageOps.autocontrast(image)  # Auto contrast
-    image = image.point(lambda x: 0 if x < 140 else 255, '1')  # Thresholding
+    image = image.point(_THRESH_LUT, '1')  # Thresholding
     return image
 
 def extract_info_from_page(page_image, pdf_path, page_number):